@@ -1,13 +1,35 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import inspect, select, update, MetaData, Table
-from database import SessionLocal, get_db, create_tables, engine, User as DBUser, Branch as DBBranch, Medicine as DBMedicine, Employee as DBEmployee, Patient as DBPatient, Transfer as DBTransfer, DispensingRecord as DBDispensingRecord, DispensingItem as DBDispensingItem, Arrival as DBArrival, DeviceArrival as DBDeviceArrival, Category as DBCategory, MedicalDevice as DBMedicalDevice, Shipment as DBShipment, ShipmentItem as DBShipmentItem, Notification as DBNotification
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import TypeAdapter
+from cachetools import TTLCache
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import inspect, select, insert, update, delete, case, exists, literal, tuple_, values, column, func, cast, String, Integer
+from sqlalchemy.dialects.postgresql import insert as pg_insert, aggregate_order_by
+from database import SessionLocal, get_db, create_tables, engine, query_count, User as DBUser, Branch as DBBranch, Medicine as DBMedicine, Employee as DBEmployee, Patient as DBPatient, Transfer as DBTransfer, DispensingRecord as DBDispensingRecord, DispensingItem as DBDispensingItem, Arrival as DBArrival, DeviceArrival as DBDeviceArrival, Category as DBCategory, MedicalDevice as DBMedicalDevice, Shipment as DBShipment, ShipmentItem as DBShipmentItem, Notification as DBNotification
 from schemas import *
 from typing import List, Optional
 from datetime import datetime
+import os
 import uuid
+import itertools
 import json
+import logging
+import threading
+import orjson
+
+
+def new_id() -> str:
+    """Random UUID4 as 32 hex chars."""
+    return uuid.uuid4().hex
+
+
+def new_ids(n: int) -> List[str]:
+    """n new_id()-style ids."""
+    # One urandom read for the whole batch instead of one per id
+    buf = os.urandom(16 * n)
+    return [uuid.UUID(bytes=buf[i:i + 16], version=4).hex for i in range(0, 16 * n, 16)]
 
 
 def ensure_schema_patches():
@@ -82,43 +104,42 @@ def ensure_schema_patches():
         conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_med_category_id ON public.medicines(category_id);")
         conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_dev_category_id ON public.medical_devices(category_id);")
 
-        # --- 2) DML: backfill using SQLAlchemy Core (no raw placeholders) ---
-
-        md = MetaData()
-        categories = Table("categories", md, autoload_with=engine)
-        medicines = Table("medicines", md, autoload_with=engine)
-        devices = Table("medical_devices", md, autoload_with=engine)
-
-        # 2a) pick a default category for medicines
-        default_med_cat_id = conn.execute(
-            select(categories.c.id)
-            .where(categories.c.type == "medicine")
-            .order_by(categories.c.name)
-            .limit(1)
-        ).scalar_one_or_none()
-
-        if default_med_cat_id is not None and "category_id" in med_cols:
-            conn.execute(
-                update(medicines)
-                .where(medicines.c.category_id.is_(None))
-                .values(category_id=default_med_cat_id)
+        # --- 2) DML: backfill missing category_id with the first category of each type ---
+        # Both columns exist once the DDL above succeeded; one round trip for both tables.
+        conn.exec_driver_sql(
+            """
+            WITH med_default AS (
+              SELECT id FROM public.categories WHERE type = 'medicine' ORDER BY name LIMIT 1
+            ), dev_default AS (
+              SELECT id FROM public.categories WHERE type = 'medical_device' ORDER BY name LIMIT 1
+            ), med_backfill AS (
+              UPDATE public.medicines SET category_id = (SELECT id FROM med_default)
+              WHERE category_id IS NULL AND EXISTS (SELECT 1 FROM med_default)
             )
+            UPDATE public.medical_devices SET category_id = (SELECT id FROM dev_default)
+            WHERE category_id IS NULL AND EXISTS (SELECT 1 FROM dev_default);
+            """
+        )
 
-        # 2b) backfill medical_devices.category_id if needed
-        default_dev_cat_id = conn.execute(
-            select(categories.c.id)
-            .where(categories.c.type == "medical_device")
-            .order_by(categories.c.name)
-            .limit(1)
-        ).scalar_one_or_none()
-
-        dev_cols = [c["name"] for c in insp.get_columns("medical_devices")]
-        if default_dev_cat_id is not None and "category_id" in dev_cols:
-            conn.execute(
-                update(devices)
-                .where(devices.c.category_id.is_(None))
-                .values(category_id=default_dev_cat_id)
-            )
+    # --- 3) Indexes for hot filters ---
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for ddl in (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_med_branch_id ON public.medicines(branch_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_dev_branch_id ON public.medical_devices(branch_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_employees_branch_id ON public.employees(branch_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_branch_id ON public.patients(branch_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transfers_to_branch_id ON public.transfers(to_branch_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_shipment_items_shipment_id ON public.shipment_items(shipment_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_dispensing_items_record_id ON public.dispensing_items(record_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_dispensing_records_branch_id ON public.dispensing_records(branch_id);",
+            # Branch shipment lists, optionally narrowed by status, newest first
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_shipments_to_branch_status_created ON public.shipments(to_branch_id, status, created_at DESC);",
+            # (name, branch_id) lookups when stock moves into a branch
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_med_name_branch_id ON public.medicines(name, branch_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_dev_name_branch_id ON public.medical_devices(name, branch_id);",
+        ):
+            conn.exec_driver_sql(ddl)
 
 
 def ensure_medicines_category_fk():
@@ -140,7 +161,261 @@ def ensure_medicines_category_fk():
         )
 
 
-# Create FastAPI app
+def stream_rows(*stmts, wrap: Optional[str] = None, chunk_size: int = 500):
+    """Stream the rows of stmts as one JSON array, or as {wrap: [...]}."""
+    # Own session: the body is sent after the handler's session is closed
+    db = SessionLocal()
+    try:
+        # Execute and fetch the first chunk now, so query errors raise before the
+        # 200 headers go out; later chunks come from the server-side cursor
+        results = []
+        for stmt in stmts:
+            partitions = db.execute(stmt.execution_options(yield_per=chunk_size)).mappings().partitions()
+            results.append((next(partitions, []), partitions))
+    except Exception:
+        db.close()
+        raise
+
+    def generate():
+        # The {wrap: prefix goes out with the first rows, never on its own
+        head = b"{" + orjson.dumps(wrap) + b":" if wrap is not None else b""
+        tail = b"}" if wrap is not None else b""
+        try:
+            sep = b"["
+            for first, rest in results:
+                for rows in itertools.chain([first], rest):
+                    if rows:
+                        yield head + sep + b",".join(orjson.dumps(dict(row)) for row in rows)
+                        head, sep = b"", b","
+            yield head + (b"[]" if sep == b"[" else b"]") + tail
+        finally:
+            db.close()
+
+    # The background task also closes the session if the body is never iterated
+    return StreamingResponse(generate(), media_type="application/json", background=BackgroundTask(db.close))
+
+
+# category id -> type. Entries can be up to ttl seconds stale in other workers,
+# so this only picks the error message after insert_with_category_check has
+# already rejected a row; validation that lets a write through reads the table.
+category_type_cache = TTLCache(maxsize=1024, ttl=60)
+category_type_lock = threading.Lock()
+
+
+def get_category_type(db: Session, category_id: str) -> Optional[str]:
+    """Return the category's type, or None if it doesn't exist."""
+    with category_type_lock:
+        cat_type = category_type_cache.get(category_id)
+    if cat_type is None:
+        cat_type = db.execute(select(DBCategory.type).where(DBCategory.id == category_id)).scalar_one_or_none()
+        if cat_type is not None:
+            with category_type_lock:
+                category_type_cache[category_id] = cat_type
+    return cat_type
+
+
+def invalidate_category_type(category_id: str):
+    with category_type_lock:
+        category_type_cache.pop(category_id, None)
+
+
+# Serialized bodies of hot read-only GETs, keyed by (endpoint, branch_id or "_all").
+# Writers in this process invalidate after commit; other workers see at most ttl
+# seconds of staleness.
+response_cache = TTLCache(maxsize=128, ttl=30)
+response_cache_lock = threading.Lock()
+
+
+def cached_response(key: tuple, build):
+    """Return response_cache[key], calling build() to fill it on a miss."""
+    with response_cache_lock:
+        body = response_cache.get(key)
+    if body is None:
+        body = build()
+        with response_cache_lock:
+            response_cache[key] = body
+    return body
+
+
+def invalidate_response(*keys: tuple):
+    with response_cache_lock:
+        for key in keys:
+            response_cache.pop(key, None)
+
+
+def delete_by_id(db: Session, model, obj_id: str) -> bool:
+    """DELETE ... RETURNING id; False if no row matched."""
+    return db.execute(delete(model).where(model.id == obj_id).returning(model.id)).scalar() is not None
+
+
+def apply_quantity_deltas(db: Session, model, deltas: dict):
+    """Add deltas[id] (negative to decrement) to each row's quantity in one UPDATE."""
+    if deltas:
+        db.execute(
+            update(model)
+            .where(model.id.in_(deltas))
+            .values(quantity=model.quantity + case(deltas, value=model.id))
+            # Loaded objects keep their old quantity until refreshed
+            .execution_options(synchronize_session=False)
+        )
+
+
+def receive_stock(db: Session, model, arrivals: list, id_attr: str):
+    """Apply arrivals to main warehouse rows of model in one UPDATE."""
+    # Sum quantities per row; the last arrival's prices win, as they would one by one
+    deltas, purchase_prices, sell_prices = {}, {}, {}
+    for arrival in arrivals:
+        row_id = getattr(arrival, id_attr)
+        deltas[row_id] = deltas.get(row_id, 0) + arrival.quantity
+        purchase_prices[row_id] = arrival.purchase_price
+        sell_prices[row_id] = arrival.sell_price
+    if deltas:
+        db.execute(
+            update(model)
+            # Ids that aren't main warehouse rows are skipped
+            .where(model.id.in_(deltas), model.branch_id.is_(None))
+            .values(
+                quantity=model.quantity + case(deltas, value=model.id),
+                purchase_price=case(purchase_prices, value=model.id),
+                sell_price=case(sell_prices, value=model.id),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+
+def shipment_item_rows(db: Session, model, item_type: str, id_key: str, items: list, shipment_id: str, label: str) -> list:
+    """Check items against main warehouse stock of model and build ShipmentItem rows."""
+    if not items:
+        return []
+    stock = {
+        row.id: row
+        for row in db.execute(
+            select(model.id, model.name, model.quantity)
+            .where(model.id.in_({i[id_key] for i in items}), model.branch_id.is_(None))
+        )
+    }
+    rows = []
+    for row_id, item in zip(new_ids(len(items)), items):
+        main = stock.get(item[id_key])
+        if not main or main.quantity < item["quantity"]:
+            raise HTTPException(status_code=400, detail=f"Insufficient {label} quantity")
+        rows.append({
+            "id": row_id,
+            "shipment_id": shipment_id,
+            "item_type": item_type,
+            "item_id": item[id_key],
+            "item_name": main.name,
+            "quantity": item["quantity"],
+        })
+    return rows
+
+
+def move_stock(db: Session, model, items: list, to_branch_id: str):
+    """Move shipment items of one model from the main warehouse to a branch."""
+    if not items:
+        return
+    main_rows = {
+        row.id: row
+        for row in db.execute(
+            select(model.id, model.category_id, model.purchase_price, model.sell_price)
+            .where(model.id.in_({i.item_id for i in items}), model.branch_id.is_(None))
+        )
+    }
+    # Branch rows are matched by name, not id
+    branch_ids = dict(db.execute(
+        select(model.name, model.id)
+        .where(model.name.in_({i.item_name for i in items}), model.branch_id == to_branch_id)
+    ).all())
+
+    deltas, new_rows = {}, {}
+    # At most one new branch row per item
+    row_ids = iter(new_ids(len(items)))
+    for item in items:
+        # Decrease main warehouse quantity
+        main = main_rows.get(item.item_id)
+        if main:
+            deltas[main.id] = deltas.get(main.id, 0) - item.quantity
+
+        # Add to branch
+        branch_id = branch_ids.get(item.item_name)
+        if branch_id:
+            deltas[branch_id] = deltas.get(branch_id, 0) + item.quantity
+        elif item.item_name in new_rows:
+            new_rows[item.item_name]["quantity"] += item.quantity
+        else:
+            # New branch rows take the main row's category and prices
+            new_rows[item.item_name] = {
+                "id": next(row_ids),
+                "name": item.item_name,
+                "category_id": main.category_id if main else None,
+                "purchase_price": main.purchase_price if main else 0,
+                "sell_price": main.sell_price if main else 0,
+                "quantity": item.quantity,
+                "branch_id": to_branch_id,
+            }
+
+    apply_quantity_deltas(db, model, deltas)
+    if new_rows:
+        db.execute(insert(model), list(new_rows.values()))
+
+
+def insert_with_category_check(db: Session, model, row: dict, category_type: str) -> bool:
+    """INSERT the row only if its category exists with category_type; False if not written."""
+    columns = list(row)
+    stmt = insert(model).from_select(
+        columns,
+        select(*[literal(row[c], getattr(model, c).type) for c in columns]).where(
+            exists().where(DBCategory.id == row["category_id"], DBCategory.type == category_type)
+        ),
+    )
+    return db.execute(stmt).rowcount > 0
+
+
+# Arbitrary app-wide key for pg_advisory_xact_lock in seed_defaults
+SEED_DEFAULTS_LOCK_ID = 7_340_221
+
+
+def seed_defaults():
+    """Insert the admin user and default categories unless they already exist."""
+    with engine.begin() as conn:
+        # Workers starting together would all pass NOT EXISTS below under READ
+        # COMMITTED; serialize them until this transaction ends
+        conn.execute(select(func.pg_advisory_xact_lock(SEED_DEFAULTS_LOCK_ID)))
+
+        conn.execute(
+            pg_insert(DBUser.__table__)
+            .values(id="admin", login="admin", password="admin", role="admin")
+            .on_conflict_do_nothing()
+        )
+
+        # categories.name has no unique constraint (user-created categories may
+        # share names), so skip existing names with NOT EXISTS instead of ON CONFLICT
+        defaults = values(
+            column("id", String),
+            column("name", String),
+            column("description", String),
+            column("type", String),
+            name="defaults",
+        ).data([
+            (new_id(), "Общие лекарства", "Общая категория лекарств", "medicine"),
+            (new_id(), "Общие ИМН", "Общая категория изделий медицинского назначения", "medical_device"),
+        ])
+        conn.execute(
+            insert(DBCategory.__table__).from_select(
+                ["id", "name", "description", "type"],
+                select(defaults).where(~exists().where(DBCategory.name == defaults.c.name)),
+            )
+        )
+
+
+# Validate/serialize whole lists in one pydantic call instead of per row
+arrival_list_adapter = TypeAdapter(List[Arrival])
+device_arrival_list_adapter = TypeAdapter(List[DeviceArrival])
+
+
+# Create FastAPI app. No app-wide ORJSONResponse: it would bypass FastAPI's
+# Pydantic serializer on response_model routes. Large dict responses without a
+# response_model return ORJSONResponse themselves.
 app = FastAPI(title="Warehouse Management System")
 
 # CORS middleware
@@ -152,41 +427,80 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+logger = logging.getLogger(__name__)
+
+# Requests issuing more SQL statements than their budget are logged, to catch
+# N+1 regressions. Handlers not listed in QUERY_BUDGETS get the default; the
+# listed ones have a fixed statement count above it that doesn't grow with the
+# number of items (for batches under the executemany page size). They are
+# hand-counted: recount when move_stock or the dispensing flow changes.
+QUERY_COUNT_WARN_THRESHOLD = int(os.getenv("QUERY_COUNT_WARN_THRESHOLD", "5"))
+QUERY_BUDGETS = {
+    # shipment + items SELECTs; per model: main and branch SELECT, UPDATE, INSERT;
+    # status UPDATE
+    ("POST", "/shipments/{shipment_id}/accept"): 11,
+    # names SELECT; per model: stock SELECT and UPDATE; record and items INSERT
+    ("POST", "/dispensing"): 7,
+}
+
+
+class QueryCountMiddleware:
+    """Pure ASGI middleware that logs requests over their SQL statement budget."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        counter = [0]
+        token = query_count.set(counter)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            query_count.reset(token)
+        # Routing stores the matched route in the shared scope; budgets use its template
+        route = scope.get("route")
+        path = route.path if route is not None else scope["path"]
+        budget = QUERY_BUDGETS.get((scope["method"], path), QUERY_COUNT_WARN_THRESHOLD)
+        if counter[0] > budget:
+            logger.warning("%s %s issued %d SQL statements (budget %d)", scope["method"], scope["path"], counter[0], budget)
+
+
+app.add_middleware(QueryCountMiddleware)
+
 # Create tables on startup
 @app.on_event("startup")
 def startup_event():
     create_tables()
-    db = SessionLocal()
-    try:
-        admin = db.query(DBUser).filter(DBUser.login == "admin").first()
-        if not admin:
-            admin = DBUser(id="admin", login="admin", password="admin", role="admin")
-            db.add(admin); db.commit()
-
-        if not db.query(DBCategory).filter(DBCategory.name == "Общие лекарства").first():
-            db.add(DBCategory(id=str(uuid.uuid4()), name="Общие лекарства",
-                              description="Общая категория лекарств", type="medicine"))
-        if not db.query(DBCategory).filter(DBCategory.name == "Общие ИМН").first():
-            db.add(DBCategory(id=str(uuid.uuid4()), name="Общие ИМН",
-                              description="Общая категория изделий медицинского назначения", type="medical_device"))
-        db.commit()
+    seed_defaults()
 
-        try:
-            ensure_medicines_category_fk()
-        except Exception:
-            db.rollback()
-        try:
-            ensure_schema_patches()
-        except Exception:
-            db.rollback()
-    finally:
-        db.close()
+    try:
+        ensure_medicines_category_fk()
+    except Exception:
+        pass
+    try:
+        ensure_schema_patches()
+    except Exception:
+        pass
 
 
 @app.get("/ping")
 def ping():
     return {"pong": True}
 
+
+@app.get("/health/db")
+def health_db(db: Session = Depends(get_db)):
+    try:
+        db.execute(select(literal(1))).scalar()
+    except Exception:
+        # Driver errors can name the host, port, database and user; keep them in the log
+        logger.exception("database health check failed")
+        raise HTTPException(status_code=503, detail="database unavailable")
+    return {"database": "ok"}
+
 # Auth endpoints
 @app.post("/auth/login", response_model=LoginResponse)
 def login(login_data: UserLogin, db: Session = Depends(get_db)):
@@ -200,18 +514,17 @@ def login(login_data: UserLogin, db: Session = Depends(get_db)):
 
 # User endpoints
 @app.get("/users", response_model=List[User])
-async def get_users(db: Session = Depends(get_db)):
-    db_users = db.query(DBUser).all()
-    return [User.model_validate(user) for user in db_users]
+def get_users():
+    return stream_rows(select(DBUser.__table__))
 
 @app.post("/users", response_model=User)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+def create_user(user: UserCreate, db: Session = Depends(get_db)):
     # Check if user already exists
-    existing_user = db.query(DBUser).filter(DBUser.login == user.login).first()
+    existing_user = db.execute(select(literal(1)).where(DBUser.login == user.login).limit(1)).scalar()
     if existing_user:
         raise HTTPException(status_code=400, detail="User with this login already exists")
     
-    user_id = str(uuid.uuid4())
+    user_id = new_id()
     db_user = DBUser(
         id=user_id,
         login=user.login,
@@ -221,11 +534,10 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
     )
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
     return User.model_validate(db_user)
 
 @app.put("/users/{user_id}", response_model=User)
-async def update_user(user_id: str, user: UserUpdate, db: Session = Depends(get_db)):
+def update_user(user_id: str, user: UserUpdate, db: Session = Depends(get_db)):
     db_user = db.query(DBUser).filter(DBUser.id == user_id).first()
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -234,28 +546,24 @@ async def update_user(user_id: str, user: UserUpdate, db: Session = Depends(get_
         setattr(db_user, field, value)
     
     db.commit()
-    db.refresh(db_user)
     return User.model_validate(db_user)
 
 @app.delete("/users/{user_id}")
-async def delete_user(user_id: str, db: Session = Depends(get_db)):
-    user = db.query(DBUser).filter(DBUser.id == user_id).first()
-    if not user:
+def delete_user(user_id: str, db: Session = Depends(get_db)):
+    if not delete_by_id(db, DBUser, user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    
-    db.delete(user)
+
     db.commit()
     return {"message": "User deleted"}
 
 # Branch endpoints
 @app.get("/branches", response_model=List[Branch])
-async def get_branches(db: Session = Depends(get_db)):
-    db_branches = db.query(DBBranch).all()
-    return [Branch.model_validate(branch) for branch in db_branches]
+def get_branches():
+    return stream_rows(select(DBBranch.__table__))
 
 @app.post("/branches", response_model=Branch)
-async def create_branch(branch: BranchCreate, db: Session = Depends(get_db)):
-    branch_id = str(uuid.uuid4())
+def create_branch(branch: BranchCreate, db: Session = Depends(get_db)):
+    branch_id = new_id()
     db_branch = DBBranch(
         id=branch_id,
         name=branch.name,
@@ -275,11 +583,10 @@ async def create_branch(branch: BranchCreate, db: Session = Depends(get_db)):
     db.add(db_user)
     
     db.commit()
-    db.refresh(db_branch)
     return Branch.model_validate(db_branch)
 
 @app.put("/branches/{branch_id}", response_model=Branch)
-async def update_branch(branch_id: str, branch: BranchUpdate, db: Session = Depends(get_db)):
+def update_branch(branch_id: str, branch: BranchUpdate, db: Session = Depends(get_db)):
     db_branch = db.query(DBBranch).filter(DBBranch.id == branch_id).first()
     if not db_branch:
         raise HTTPException(status_code=404, detail="Branch not found")
@@ -298,151 +605,125 @@ async def update_branch(branch_id: str, branch: BranchUpdate, db: Session = Depe
             db_user.branch_name = branch.name
     
     db.commit()
-    db.refresh(db_branch)
     return Branch.model_validate(db_branch)
 
 @app.delete("/branches/{branch_id}")
-async def delete_branch(branch_id: str, db: Session = Depends(get_db)):
-    branch = db.query(DBBranch).filter(DBBranch.id == branch_id).first()
-    if not branch:
+def delete_branch(branch_id: str, db: Session = Depends(get_db)):
+    # Delete the branch and its corresponding user in one statement
+    deleted_user = delete(DBUser).where(DBUser.id == branch_id).cte("deleted_user")
+    deleted = db.execute(
+        delete(DBBranch).where(DBBranch.id == branch_id).add_cte(deleted_user).returning(DBBranch.id)
+    ).scalar()
+    if deleted is None:
+        # nothing is committed, so the user delete is rolled back with the session
         raise HTTPException(status_code=404, detail="Branch not found")
-    
-    # Delete corresponding user
-    user = db.query(DBUser).filter(DBUser.id == branch_id).first()
-    if user:
-        db.delete(user)
-    
-    db.delete(branch)
+
     db.commit()
     return {"message": "Branch deleted"}
 
 # Medicine endpoints
 @app.get("/medicines", response_model=List[Medicine])
-async def get_medicines(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_medicines(branch_id: Optional[str] = None):
+    stmt = select(DBMedicine.__table__)
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        db_medicines = db.query(DBMedicine).filter(DBMedicine.branch_id == branch_id).all()
+        stmt = stmt.where(DBMedicine.branch_id == branch_id)
     else:
-        db_medicines = db.query(DBMedicine).filter(DBMedicine.branch_id.is_(None)).all()
-    return [Medicine.model_validate(medicine) for medicine in db_medicines]
+        stmt = stmt.where(DBMedicine.branch_id.is_(None))
+    return stream_rows(stmt)
 
 @app.post("/medicines", response_model=Medicine)
-async def create_medicine(medicine: MedicineCreate, db: Session = Depends(get_db)):
-    cat = db.query(DBCategory).filter(DBCategory.id == medicine.category_id).first()
-    if not cat:
-        raise HTTPException(status_code=400, detail="Category not found")
-    if cat.type != "medicine":
+def create_medicine(medicine: MedicineCreate, db: Session = Depends(get_db)):
+    medicine_id = new_id()
+    row = {"id": medicine_id, **medicine.model_dump()}
+    if not insert_with_category_check(db, DBMedicine, row, "medicine"):
+        cat_type = get_category_type(db, medicine.category_id)
+        if cat_type is None:
+            raise HTTPException(status_code=400, detail="Category not found")
         raise HTTPException(status_code=400, detail="Invalid category for medicine")
 
-    medicine_id = str(uuid.uuid4())
-    db_medicine = DBMedicine(
-        id=medicine_id,
-        name=medicine.name,
-        category_id=medicine.category_id,
-        purchase_price=medicine.purchase_price,
-        sell_price=medicine.sell_price,
-        quantity=medicine.quantity,
-        branch_id=medicine.branch_id,
-    )
-    db.add(db_medicine)
     db.commit()
-    db.refresh(db_medicine)
-    return Medicine.model_validate(db_medicine)
+    return Medicine(**row)
 
 @app.put("/medicines/{medicine_id}", response_model=Medicine)
-async def update_medicine(medicine_id: str, medicine: MedicineUpdate, db: Session = Depends(get_db)):
+def update_medicine(medicine_id: str, medicine: MedicineUpdate, db: Session = Depends(get_db)):
     db_medicine = db.query(DBMedicine).filter(DBMedicine.id == medicine_id).first()
     if not db_medicine:
         raise HTTPException(status_code=404, detail="Medicine not found")
 
     category_id = medicine.category_id if medicine.category_id is not None else db_medicine.category_id
-    cat = db.query(DBCategory).filter(DBCategory.id == category_id).first()
-    if not cat:
+    cat_type = db.execute(select(DBCategory.type).where(DBCategory.id == category_id)).scalar_one_or_none()
+    if cat_type is None:
         raise HTTPException(status_code=400, detail="Category not found")
-    if cat.type != "medicine":
+    if cat_type != "medicine":
         raise HTTPException(status_code=400, detail="Invalid category for medicine")
     
     for field, value in medicine.model_dump(exclude_unset=True).items():
         setattr(db_medicine, field, value)
 
     db.commit()
-    db.refresh(db_medicine)
     return Medicine.model_validate(db_medicine)
 
 @app.delete("/medicines/{medicine_id}")
-async def delete_medicine(medicine_id: str, db: Session = Depends(get_db)):
-    medicine = db.query(DBMedicine).filter(DBMedicine.id == medicine_id).first()
-    if not medicine:
+def delete_medicine(medicine_id: str, db: Session = Depends(get_db)):
+    if not delete_by_id(db, DBMedicine, medicine_id):
         raise HTTPException(status_code=404, detail="Medicine not found")
-    
-    db.delete(medicine)
+
     db.commit()
     return {"message": "Medicine deleted"}
 
 # Medical Device endpoints
 @app.get("/medical_devices", response_model=List[MedicalDevice])
-async def get_medical_devices(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_medical_devices(branch_id: Optional[str] = None):
+    stmt = select(DBMedicalDevice.__table__)
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        db_devices = db.query(DBMedicalDevice).filter(DBMedicalDevice.branch_id == branch_id).all()
+        stmt = stmt.where(DBMedicalDevice.branch_id == branch_id)
     else:
-        db_devices = db.query(DBMedicalDevice).filter(DBMedicalDevice.branch_id.is_(None)).all()
-    return [MedicalDevice.model_validate(device) for device in db_devices]
+        stmt = stmt.where(DBMedicalDevice.branch_id.is_(None))
+    return stream_rows(stmt)
 
 @app.post("/medical_devices", response_model=MedicalDevice)
-async def create_medical_device(device: MedicalDeviceCreate, db: Session = Depends(get_db)):
-    cat = db.query(DBCategory).filter(DBCategory.id == device.category_id).first()
-    if not cat:
-        raise HTTPException(status_code=400, detail="Category not found")
-    if cat.type != "medical_device":
+def create_medical_device(device: MedicalDeviceCreate, db: Session = Depends(get_db)):
+    device_id = new_id()
+    row = {"id": device_id, **device.model_dump()}
+    if not insert_with_category_check(db, DBMedicalDevice, row, "medical_device"):
+        cat_type = get_category_type(db, device.category_id)
+        if cat_type is None:
+            raise HTTPException(status_code=400, detail="Category not found")
         raise HTTPException(status_code=400, detail="Invalid category for medical device")
 
-    device_id = str(uuid.uuid4())
-    db_device = DBMedicalDevice(
-        id=device_id,
-        name=device.name,
-        category_id=device.category_id,
-        purchase_price=device.purchase_price,
-        sell_price=device.sell_price,
-        quantity=device.quantity,
-        branch_id=device.branch_id,
-    )
-    db.add(db_device)
     db.commit()
-    db.refresh(db_device)
-    return MedicalDevice.model_validate(db_device)
+    return MedicalDevice(**row)
 
 @app.put("/medical_devices/{device_id}", response_model=MedicalDevice)
-async def update_medical_device(device_id: str, device: MedicalDeviceUpdate, db: Session = Depends(get_db)):
+def update_medical_device(device_id: str, device: MedicalDeviceUpdate, db: Session = Depends(get_db)):
     db_device = db.query(DBMedicalDevice).filter(DBMedicalDevice.id == device_id).first()
     if not db_device:
         raise HTTPException(status_code=404, detail="Medical device not found")
 
     category_id = device.category_id if device.category_id is not None else db_device.category_id
-    cat = db.query(DBCategory).filter(DBCategory.id == category_id).first()
-    if not cat:
+    cat_type = db.execute(select(DBCategory.type).where(DBCategory.id == category_id)).scalar_one_or_none()
+    if cat_type is None:
         raise HTTPException(status_code=400, detail="Category not found")
-    if cat.type != "medical_device":
+    if cat_type != "medical_device":
         raise HTTPException(status_code=400, detail="Invalid category for medical device")
 
     for field, value in device.model_dump(exclude_unset=True).items():
         setattr(db_device, field, value)
 
     db.commit()
-    db.refresh(db_device)
     return MedicalDevice.model_validate(db_device)
 
 @app.delete("/medical_devices/{device_id}")
-async def delete_medical_device(device_id: str, db: Session = Depends(get_db)):
-    device = db.query(DBMedicalDevice).filter(DBMedicalDevice.id == device_id).first()
-    if not device:
+def delete_medical_device(device_id: str, db: Session = Depends(get_db)):
+    if not delete_by_id(db, DBMedicalDevice, device_id):
         raise HTTPException(status_code=404, detail="Medical device not found")
-    
-    db.delete(device)
+
     db.commit()
     return {"message": "Medical device deleted"}
 
 # Category endpoints
 @app.get("/categories", response_model=List[dict])
-async def get_categories(type: Optional[str] = None, db: Session = Depends(get_db)):
+def get_categories(type: Optional[str] = None, db: Session = Depends(get_db)):
     query = db.query(DBCategory)
     if type:
         query = query.filter(DBCategory.type == type)
@@ -450,8 +731,8 @@ async def get_categories(type: Optional[str] = None, db: Session = Depends(get_d
     return [{"id": cat.id, "name": cat.name, "description": cat.description, "type": cat.type} for cat in categories]
 
 @app.post("/categories")
-async def create_category(category: dict, db: Session = Depends(get_db)):
-    category_id = str(uuid.uuid4())
+def create_category(category: dict, db: Session = Depends(get_db)):
+    category_id = new_id()
     db_category = DBCategory(
         id=category_id,
         name=category["name"],
@@ -460,11 +741,10 @@ async def create_category(category: dict, db: Session = Depends(get_db)):
     )
     db.add(db_category)
     db.commit()
-    db.refresh(db_category)
     return {"id": db_category.id, "name": db_category.name, "description": db_category.description, "type": db_category.type}
 
 @app.put("/categories/{category_id}")
-async def update_category(category_id: str, category: dict, db: Session = Depends(get_db)):
+def update_category(category_id: str, category: dict, db: Session = Depends(get_db)):
     db_category = db.query(DBCategory).filter(DBCategory.id == category_id).first()
     if not db_category:
         raise HTTPException(status_code=404, detail="Category not found")
@@ -474,40 +754,46 @@ async def update_category(category_id: str, category: dict, db: Session = Depend
             setattr(db_category, field, value)
     
     db.commit()
-    db.refresh(db_category)
+    invalidate_category_type(category_id)
     return {"id": db_category.id, "name": db_category.name, "description": db_category.description, "type": db_category.type}
 
 @app.delete("/categories/{category_id}")
-async def delete_category(category_id: str, db: Session = Depends(get_db)):
-    category = db.query(DBCategory).filter(DBCategory.id == category_id).first()
-    if not category:
-        raise HTTPException(status_code=404, detail="Category not found")
-
-    if category.type == "medicine":
-        count = db.query(DBMedicine).filter(DBMedicine.category_id == category_id).count()
-        if count > 0:
+def delete_category(category_id: str, db: Session = Depends(get_db)):
+    # Guard and delete in one statement; never trust the category type cache here
+    deleted = db.execute(
+        delete(DBCategory)
+        .where(
+            DBCategory.id == category_id,
+            ~exists().where(DBMedicine.category_id == category_id),
+            ~exists().where(DBMedicalDevice.category_id == category_id),
+        )
+        .returning(DBCategory.id)
+    ).scalar()
+    if deleted is None:
+        # Nothing deleted: the category is missing or still referenced
+        if db.execute(select(DBCategory.id).where(DBCategory.id == category_id)).scalar() is None:
+            raise HTTPException(status_code=404, detail="Category not found")
+        if db.execute(select(exists().where(DBMedicine.category_id == category_id))).scalar():
             raise HTTPException(status_code=400, detail="Cannot delete: category has medicines")
-    elif category.type == "medical_device":
-        count = db.query(DBMedicalDevice).filter(DBMedicalDevice.category_id == category_id).count()
-        if count > 0:
-            raise HTTPException(status_code=400, detail="Cannot delete: category has medical devices")
+        raise HTTPException(status_code=400, detail="Cannot delete: category has medical devices")
 
-    db.delete(category)
     db.commit()
+    invalidate_category_type(category_id)
     return {"message": "Category deleted"}
 
 # Employee endpoints
 @app.get("/employees", response_model=List[Employee])
-async def get_employees(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_employees(branch_id: Optional[str] = None):
+    stmt = select(DBEmployee.__table__)
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        db_employees = db.query(DBEmployee).filter(DBEmployee.branch_id == branch_id).all()
+        stmt = stmt.where(DBEmployee.branch_id == branch_id)
     else:
-        db_employees = db.query(DBEmployee).filter(DBEmployee.branch_id.is_(None)).all()
-    return [Employee.model_validate(employee) for employee in db_employees]
+        stmt = stmt.where(DBEmployee.branch_id.is_(None))
+    return stream_rows(stmt)
 
 @app.post("/employees", response_model=Employee)
-async def create_employee(employee: EmployeeCreate, db: Session = Depends(get_db)):
-    employee_id = str(uuid.uuid4())
+def create_employee(employee: EmployeeCreate, db: Session = Depends(get_db)):
+    employee_id = new_id()
     db_employee = DBEmployee(
         id=employee_id,
         first_name=employee.first_name,
@@ -518,11 +804,10 @@ async def create_employee(employee: EmployeeCreate, db: Session = Depends(get_db
     )
     db.add(db_employee)
     db.commit()
-    db.refresh(db_employee)
     return Employee.model_validate(db_employee)
 
 @app.put("/employees/{employee_id}", response_model=Employee)
-async def update_employee(employee_id: str, employee: EmployeeUpdate, db: Session = Depends(get_db)):
+def update_employee(employee_id: str, employee: EmployeeUpdate, db: Session = Depends(get_db)):
     db_employee = db.query(DBEmployee).filter(DBEmployee.id == employee_id).first()
     if not db_employee:
         raise HTTPException(status_code=404, detail="Employee not found")
@@ -531,31 +816,27 @@ async def update_employee(employee_id: str, employee: EmployeeUpdate, db: Sessio
         setattr(db_employee, field, value)
     
     db.commit()
-    db.refresh(db_employee)
     return Employee.model_validate(db_employee)
 
 @app.delete("/employees/{employee_id}")
-async def delete_employee(employee_id: str, db: Session = Depends(get_db)):
-    employee = db.query(DBEmployee).filter(DBEmployee.id == employee_id).first()
-    if not employee:
+def delete_employee(employee_id: str, db: Session = Depends(get_db)):
+    if not delete_by_id(db, DBEmployee, employee_id):
         raise HTTPException(status_code=404, detail="Employee not found")
-    
-    db.delete(employee)
+
     db.commit()
     return {"message": "Employee deleted"}
 
 # Patient endpoints
 @app.get("/patients", response_model=List[Patient])
-async def get_patients(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_patients(branch_id: Optional[str] = None):
+    stmt = select(DBPatient.__table__)
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        db_patients = db.query(DBPatient).filter(DBPatient.branch_id == branch_id).all()
-    else:
-        db_patients = db.query(DBPatient).all()
-    return [Patient.model_validate(patient) for patient in db_patients]
+        stmt = stmt.where(DBPatient.branch_id == branch_id)
+    return stream_rows(stmt)
 
 @app.post("/patients", response_model=Patient)
-async def create_patient(patient: PatientCreate, db: Session = Depends(get_db)):
-    patient_id = str(uuid.uuid4())
+def create_patient(patient: PatientCreate, db: Session = Depends(get_db)):
+    patient_id = new_id()
     db_patient = DBPatient(
         id=patient_id,
         first_name=patient.first_name,
@@ -567,11 +848,10 @@ async def create_patient(patient: PatientCreate, db: Session = Depends(get_db)):
     )
     db.add(db_patient)
     db.commit()
-    db.refresh(db_patient)
     return Patient.model_validate(db_patient)
 
 @app.put("/patients/{patient_id}", response_model=Patient)
-async def update_patient(patient_id: str, patient: PatientUpdate, db: Session = Depends(get_db)):
+def update_patient(patient_id: str, patient: PatientUpdate, db: Session = Depends(get_db)):
     db_patient = db.query(DBPatient).filter(DBPatient.id == patient_id).first()
     if not db_patient:
         raise HTTPException(status_code=404, detail="Patient not found")
@@ -580,75 +860,103 @@ async def update_patient(patient_id: str, patient: PatientUpdate, db: Session =
         setattr(db_patient, field, value)
     
     db.commit()
-    db.refresh(db_patient)
     return Patient.model_validate(db_patient)
 
 @app.delete("/patients/{patient_id}")
-async def delete_patient(patient_id: str, db: Session = Depends(get_db)):
-    patient = db.query(DBPatient).filter(DBPatient.id == patient_id).first()
-    if not patient:
+def delete_patient(patient_id: str, db: Session = Depends(get_db)):
+    if not delete_by_id(db, DBPatient, patient_id):
         raise HTTPException(status_code=404, detail="Patient not found")
-    
-    db.delete(patient)
+
     db.commit()
     return {"message": "Patient deleted"}
 
 # Transfer endpoints
 @app.get("/transfers", response_model=List[Transfer])
-async def get_transfers(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_transfers(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        db_transfers = db.query(DBTransfer).filter(DBTransfer.to_branch_id == branch_id).all()
-    else:
-        db_transfers = db.query(DBTransfer).all()
-    return [Transfer.model_validate(transfer) for transfer in db_transfers]
+        return db.query(DBTransfer).filter(DBTransfer.to_branch_id == branch_id).all()
+    return db.query(DBTransfer).all()
 
 @app.post("/transfers")
-async def create_transfers(batch: BatchTransferCreate, db: Session = Depends(get_db)):
+def create_transfers(batch: BatchTransferCreate, db: Session = Depends(get_db)):
     try:
+        if not batch.transfers:
+            return {"message": "Transfers completed"}
+
+        # Aggregate deltas per main medicine and per (name, branch)
+        main_deltas = {}
+        branch_deltas = {}
+        branch_sources = {}
         for transfer_data in batch.transfers:
-            # Check main warehouse medicine
-            main_medicine = db.query(DBMedicine).filter(
-                DBMedicine.id == transfer_data.medicine_id,
-                DBMedicine.branch_id.is_(None)
-            ).first()
-            
-            if not main_medicine or main_medicine.quantity < transfer_data.quantity:
-                raise HTTPException(status_code=400, detail=f"Not enough {transfer_data.medicine_name} in main warehouse")
-            
-            # Decrease quantity in main warehouse
-            main_medicine.quantity -= transfer_data.quantity
-            
-            # Find or create medicine in branch
-            branch_medicine = db.query(DBMedicine).filter(
-                DBMedicine.name == transfer_data.medicine_name,
-                DBMedicine.branch_id == transfer_data.to_branch_id
-            ).first()
-            
-            if branch_medicine:
-                branch_medicine.quantity += transfer_data.quantity
-            else:
-                new_branch_medicine = DBMedicine(
-                    id=str(uuid.uuid4()),
-                    name=transfer_data.medicine_name,
-                    category_id=main_medicine.category_id,
-                    purchase_price=main_medicine.purchase_price,
-                    sell_price=main_medicine.sell_price,
-                    quantity=transfer_data.quantity,
-                    branch_id=transfer_data.to_branch_id
+            main_deltas[transfer_data.medicine_id] = main_deltas.get(transfer_data.medicine_id, 0) + transfer_data.quantity
+            key = (transfer_data.medicine_name, transfer_data.to_branch_id)
+            branch_deltas[key] = branch_deltas.get(key, 0) + transfer_data.quantity
+            branch_sources.setdefault(key, transfer_data.medicine_id)
+
+        # Decrease main warehouse stock in one atomic UPDATE; rows without enough
+        # stock are left untouched and missing from RETURNING
+        main_medicines = {
+            m.id: m
+            for m in db.execute(
+                update(DBMedicine)
+                .where(
+                    DBMedicine.id.in_(main_deltas),
+                    DBMedicine.branch_id.is_(None),
+                    DBMedicine.quantity >= case(main_deltas, value=DBMedicine.id),
                 )
-                db.add(new_branch_medicine)
-            
-            # Create transfer record
-            db_transfer = DBTransfer(
-                id=str(uuid.uuid4()),
-                medicine_id=transfer_data.medicine_id,
-                medicine_name=transfer_data.medicine_name,
-                quantity=transfer_data.quantity,
-                from_branch_id=transfer_data.from_branch_id or "main",
-                to_branch_id=transfer_data.to_branch_id
+                .values(quantity=DBMedicine.quantity - case(main_deltas, value=DBMedicine.id))
+                .returning(DBMedicine.id, DBMedicine.category_id, DBMedicine.purchase_price, DBMedicine.sell_price)
+                .execution_options(synchronize_session=False)
             )
-            db.add(db_transfer)
-        
+        }
+        for transfer_data in batch.transfers:
+            if transfer_data.medicine_id not in main_medicines:
+                raise HTTPException(status_code=400, detail=f"Not enough {transfer_data.medicine_name} in main warehouse")
+
+        # Find existing branch medicines, update them and create the rest
+        existing = {
+            (m.name, m.branch_id): m.id
+            for m in db.execute(
+                select(DBMedicine.id, DBMedicine.name, DBMedicine.branch_id)
+                .where(tuple_(DBMedicine.name, DBMedicine.branch_id).in_(list(branch_deltas)))
+            )
+        }
+        apply_quantity_deltas(
+            db, DBMedicine, {existing[key]: qty for key, qty in branch_deltas.items() if key in existing}
+        )
+
+        new_keys = [key for key in branch_deltas if key not in existing]
+        new_medicines = [
+            {
+                "id": medicine_id,
+                "name": name,
+                "category_id": main_medicines[branch_sources[(name, to_branch_id)]].category_id,
+                "purchase_price": main_medicines[branch_sources[(name, to_branch_id)]].purchase_price,
+                "sell_price": main_medicines[branch_sources[(name, to_branch_id)]].sell_price,
+                "quantity": branch_deltas[(name, to_branch_id)],
+                "branch_id": to_branch_id,
+            }
+            for medicine_id, (name, to_branch_id) in zip(new_ids(len(new_keys)), new_keys)
+        ]
+        if new_medicines:
+            db.execute(insert(DBMedicine), new_medicines)
+
+        # Create transfer records
+        db.execute(
+            insert(DBTransfer),
+            [
+                {
+                    "id": transfer_id,
+                    "medicine_id": transfer_data.medicine_id,
+                    "medicine_name": transfer_data.medicine_name,
+                    "quantity": transfer_data.quantity,
+                    "from_branch_id": transfer_data.from_branch_id or "main",
+                    "to_branch_id": transfer_data.to_branch_id,
+                }
+                for transfer_id, transfer_data in zip(new_ids(len(batch.transfers)), batch.transfers)
+            ],
+        )
+
         db.commit()
         return {"message": "Transfers completed"}
     except Exception as e:
@@ -657,28 +965,26 @@ async def create_transfers(batch: BatchTransferCreate, db: Session = Depends(get
 
 # Shipment endpoints
 @app.get("/shipments")
-async def get_shipments(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_shipments(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+    # Load all items in one extra IN query instead of one query per shipment
+    query = db.query(DBShipment).options(selectinload(DBShipment.items))
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        shipments = db.query(DBShipment).filter(DBShipment.to_branch_id == branch_id).all()
-    else:
-        shipments = db.query(DBShipment).all()
+        query = query.filter(DBShipment.to_branch_id == branch_id)
+    shipments = query.all()
     
     result = []
     for shipment in shipments:
-        # Get shipment items
-        items = db.query(DBShipmentItem).filter(DBShipmentItem.shipment_id == shipment.id).all()
-        
         shipment_data = {
             "id": shipment.id,
             "to_branch_id": shipment.to_branch_id,
             "status": shipment.status,
             "rejection_reason": shipment.rejection_reason,
-            "created_at": shipment.created_at.isoformat(),
+            "created_at": shipment.created_at,
             "medicines": [],
             "medical_devices": []
         }
         
-        for item in items:
+        for item in shipment.items:
             if item.item_type == "medicine":
                 shipment_data["medicines"].append({
                     "medicine_id": item.item_id,
@@ -694,12 +1000,12 @@ async def get_shipments(branch_id: Optional[str] = None, db: Session = Depends(g
         
         result.append(shipment_data)
     
-    return {"data": result}
+    return ORJSONResponse({"data": result})
 
 @app.post("/shipments")
-async def create_shipment(shipment_data: dict, db: Session = Depends(get_db)):
+def create_shipment(shipment_data: dict, db: Session = Depends(get_db)):
     try:
-        shipment_id = str(uuid.uuid4())
+        shipment_id = new_id()
         
         # Create shipment
         db_shipment = DBShipment(
@@ -709,53 +1015,23 @@ async def create_shipment(shipment_data: dict, db: Session = Depends(get_db)):
         )
         db.add(db_shipment)
         
-        # Add medicines
-        if "medicines" in shipment_data:
-            for medicine_item in shipment_data["medicines"]:
-                medicine = db.query(DBMedicine).filter(
-                    DBMedicine.id == medicine_item["medicine_id"],
-                    DBMedicine.branch_id.is_(None)
-                ).first()
-                
-                if not medicine or medicine.quantity < medicine_item["quantity"]:
-                    raise HTTPException(status_code=400, detail=f"Insufficient medicine quantity")
-                
-                # Create shipment item
-                db_item = DBShipmentItem(
-                    id=str(uuid.uuid4()),
-                    shipment_id=shipment_id,
-                    item_type="medicine",
-                    item_id=medicine_item["medicine_id"],
-                    item_name=medicine.name,
-                    quantity=medicine_item["quantity"]
-                )
-                db.add(db_item)
-        
-        # Add medical devices
-        if "medical_devices" in shipment_data:
-            for device_item in shipment_data["medical_devices"]:
-                device = db.query(DBMedicalDevice).filter(
-                    DBMedicalDevice.id == device_item["device_id"],
-                    DBMedicalDevice.branch_id.is_(None)
-                ).first()
-                
-                if not device or device.quantity < device_item["quantity"]:
-                    raise HTTPException(status_code=400, detail=f"Insufficient medical device quantity")
-                
-                # Create shipment item
-                db_item = DBShipmentItem(
-                    id=str(uuid.uuid4()),
-                    shipment_id=shipment_id,
-                    item_type="medical_device",
-                    item_id=device_item["device_id"],
-                    item_name=device.name,
-                    quantity=device_item["quantity"]
-                )
-                db.add(db_item)
-        
+        medicine_items = shipment_data.get("medicines") or []
+        device_items = shipment_data.get("medical_devices") or []
+
+        item_rows = shipment_item_rows(
+            db, DBMedicine, "medicine", "medicine_id", medicine_items, shipment_id, "medicine"
+        ) + shipment_item_rows(
+            db, DBMedicalDevice, "medical_device", "device_id", device_items, shipment_id, "medical device"
+        )
+
+        # The shipment row must exist before its items are bulk-inserted
+        db.flush()
+        if item_rows:
+            db.execute(insert(DBShipmentItem), item_rows)
+
         # Create notification for branch
         notification = DBNotification(
-            id=str(uuid.uuid4()),
+            id=new_id(),
             branch_id=shipment_data["to_branch_id"],
             title="Новая отправка",
             message=f"Поступление от главного склада",
@@ -764,13 +1040,14 @@ async def create_shipment(shipment_data: dict, db: Session = Depends(get_db)):
         db.add(notification)
         
         db.commit()
+        invalidate_response(("notifications", notification.branch_id), ("notifications", "_all"))
         return {"message": "Shipment created successfully"}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/shipments/{shipment_id}/accept")
-async def accept_shipment(shipment_id: str, db: Session = Depends(get_db)):
+def accept_shipment(shipment_id: str, db: Session = Depends(get_db)):
     try:
         shipment = db.query(DBShipment).filter(DBShipment.id == shipment_id).first()
         if not shipment:
@@ -778,66 +1055,10 @@ async def accept_shipment(shipment_id: str, db: Session = Depends(get_db)):
         
         # Get shipment items
         items = db.query(DBShipmentItem).filter(DBShipmentItem.shipment_id == shipment_id).all()
-        
-        for item in items:
-            if item.item_type == "medicine":
-                # Decrease main warehouse quantity
-                main_medicine = db.query(DBMedicine).filter(
-                    DBMedicine.id == item.item_id,
-                    DBMedicine.branch_id.is_(None)
-                ).first()
-                if main_medicine:
-                    main_medicine.quantity -= item.quantity
-                
-                # Add to branch
-                branch_medicine = db.query(DBMedicine).filter(
-                    DBMedicine.name == item.item_name,
-                    DBMedicine.branch_id == shipment.to_branch_id
-                ).first()
-                
-                if branch_medicine:
-                    branch_medicine.quantity += item.quantity
-                else:
-                    new_medicine = DBMedicine(
-                        id=str(uuid.uuid4()),
-                        name=item.item_name,
-                        category_id=main_medicine.category_id if main_medicine else None,
-                        purchase_price=main_medicine.purchase_price if main_medicine else 0,
-                        sell_price=main_medicine.sell_price if main_medicine else 0,
-                        quantity=item.quantity,
-                        branch_id=shipment.to_branch_id
-                    )
-                    db.add(new_medicine)
-            
-            elif item.item_type == "medical_device":
-                # Decrease main warehouse quantity
-                main_device = db.query(DBMedicalDevice).filter(
-                    DBMedicalDevice.id == item.item_id,
-                    DBMedicalDevice.branch_id.is_(None)
-                ).first()
-                if main_device:
-                    main_device.quantity -= item.quantity
-                
-                # Add to branch
-                branch_device = db.query(DBMedicalDevice).filter(
-                    DBMedicalDevice.name == item.item_name,
-                    DBMedicalDevice.branch_id == shipment.to_branch_id
-                ).first()
-                
-                if branch_device:
-                    branch_device.quantity += item.quantity
-                else:
-                    new_device = DBMedicalDevice(
-                        id=str(uuid.uuid4()),
-                        name=item.item_name,
-                        category_id=main_device.category_id if main_device else None,
-                        purchase_price=main_device.purchase_price if main_device else 0,
-                        sell_price=main_device.sell_price if main_device else 0,
-                        quantity=item.quantity,
-                        branch_id=shipment.to_branch_id
-                    )
-                    db.add(new_device)
-        
+
+        move_stock(db, DBMedicine, [i for i in items if i.item_type == "medicine"], shipment.to_branch_id)
+        move_stock(db, DBMedicalDevice, [i for i in items if i.item_type == "medical_device"], shipment.to_branch_id)
+
         shipment.status = "accepted"
         db.commit()
         return {"message": "Shipment accepted"}
@@ -846,7 +1067,7 @@ async def accept_shipment(shipment_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/shipments/{shipment_id}/reject")
-async def reject_shipment(shipment_id: str, reason: dict, db: Session = Depends(get_db)):
+def reject_shipment(shipment_id: str, reason: dict, db: Session = Depends(get_db)):
     shipment = db.query(DBShipment).filter(DBShipment.id == shipment_id).first()
     if not shipment:
         raise HTTPException(status_code=404, detail="Shipment not found")
@@ -857,7 +1078,7 @@ async def reject_shipment(shipment_id: str, reason: dict, db: Session = Depends(
     return {"message": "Shipment rejected"}
 
 @app.put("/shipments/{shipment_id}/status")
-async def update_shipment_status(shipment_id: str, status_data: dict, db: Session = Depends(get_db)):
+def update_shipment_status(shipment_id: str, status_data: dict, db: Session = Depends(get_db)):
     shipment = db.query(DBShipment).filter(DBShipment.id == shipment_id).first()
     if not shipment:
         raise HTTPException(status_code=404, detail="Shipment not found")
@@ -868,48 +1089,51 @@ async def update_shipment_status(shipment_id: str, status_data: dict, db: Sessio
 
 # Notification endpoints
 @app.get("/notifications")
-async def get_notifications(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
-    if branch_id:
-        notifications = db.query(DBNotification).filter(DBNotification.branch_id == branch_id).order_by(DBNotification.created_at.desc()).all()
-    else:
-        notifications = db.query(DBNotification).order_by(DBNotification.created_at.desc()).all()
-    
-    return {
-        "data": [
-            {
-                "id": n.id,
-                "branch_id": n.branch_id,
-                "title": n.title,
-                "message": n.message,
-                "is_read": bool(n.is_read),
-                "created_at": n.created_at.isoformat()
-            }
-            for n in notifications
-        ]
-    }
+def get_notifications(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+    def build():
+        if branch_id:
+            notifications = db.query(DBNotification).filter(DBNotification.branch_id == branch_id).order_by(DBNotification.created_at.desc()).all()
+        else:
+            notifications = db.query(DBNotification).order_by(DBNotification.created_at.desc()).all()
+
+        return {
+            "data": [
+                {
+                    "id": n.id,
+                    "branch_id": n.branch_id,
+                    "title": n.title,
+                    "message": n.message,
+                    "is_read": bool(n.is_read),
+                    "created_at": n.created_at
+                }
+                for n in notifications
+            ]
+        }
+
+    return ORJSONResponse(cached_response(("notifications", branch_id or "_all"), build))
 
 @app.put("/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: str, db: Session = Depends(get_db)):
+def mark_notification_read(notification_id: str, db: Session = Depends(get_db)):
     notification = db.query(DBNotification).filter(DBNotification.id == notification_id).first()
     if not notification:
         raise HTTPException(status_code=404, detail="Notification not found")
     
     notification.is_read = 1
     db.commit()
+    invalidate_response(("notifications", notification.branch_id), ("notifications", "_all"))
     return {"message": "Notification marked as read"}
 
 # Dispensing endpoints
 @app.get("/dispensing_records")
-async def get_dispensing_records(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_dispensing_records(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+    # Load all items in one extra IN query instead of one query per record
+    query = db.query(DBDispensingRecord).options(selectinload(DBDispensingRecord.items))
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        records = db.query(DBDispensingRecord).filter(DBDispensingRecord.branch_id == branch_id).all()
-    else:
-        records = db.query(DBDispensingRecord).all()
+        query = query.filter(DBDispensingRecord.branch_id == branch_id)
+    records = query.all()
     
     result = []
     for record in records:
-        items = db.query(DBDispensingItem).filter(DBDispensingItem.record_id == record.id).all()
-        
         record_data = {
             "id": record.id,
             "patient_id": record.patient_id,
@@ -917,12 +1141,12 @@ async def get_dispensing_records(branch_id: Optional[str] = None, db: Session =
             "employee_id": record.employee_id,
             "employee_name": record.employee_name,
             "branch_id": record.branch_id,
-            "date": record.date.isoformat(),
+            "date": record.date,
             "medicines": [],
             "medical_devices": []
         }
         
-        for item in items:
+        for item in record.items:
             if item.item_type == "medicine":
                 record_data["medicines"].append({
                     "medicine_name": item.item_name,
@@ -936,83 +1160,95 @@ async def get_dispensing_records(branch_id: Optional[str] = None, db: Session =
         
         result.append(record_data)
     
-    return {"data": result}
+    return ORJSONResponse({"data": result})
 
 @app.post("/dispensing")
-async def create_dispensing_record(request: dict, db: Session = Depends(get_db)):
+def create_dispensing_record(request: dict, db: Session = Depends(get_db)):
     try:
         patient_id = request["patient_id"]
         employee_id = request["employee_id"]
         branch_id = request["branch_id"]
         items = request["items"]
         
-        # Get patient and employee names
-        patient = db.query(DBPatient).filter(DBPatient.id == patient_id).first()
-        employee = db.query(DBEmployee).filter(DBEmployee.id == employee_id).first()
+        # Get patient and employee names in one round-trip; both sides are
+        # primary-key lookups, so the join yields at most one row
+        names = db.execute(
+            select(
+                DBPatient.first_name.label("patient_first_name"),
+                DBPatient.last_name.label("patient_last_name"),
+                DBEmployee.first_name.label("employee_first_name"),
+                DBEmployee.last_name.label("employee_last_name"),
+            )
+            .join(DBEmployee, DBEmployee.id == employee_id)
+            .where(DBPatient.id == patient_id)
+        ).first()
         
-        if not patient or not employee:
+        if names is None:
             raise HTTPException(status_code=404, detail="Patient or employee not found")
         
         # Create dispensing record
-        record_id = str(uuid.uuid4())
+        record_id = new_id()
         db_record = DBDispensingRecord(
             id=record_id,
             patient_id=patient_id,
-            patient_name=f"{patient.first_name} {patient.last_name}",
+            patient_name=f"{names.patient_first_name} {names.patient_last_name}",
             employee_id=employee_id,
-            employee_name=f"{employee.first_name} {employee.last_name}",
+            employee_name=f"{names.employee_first_name} {names.employee_last_name}",
             branch_id=branch_id
         )
         db.add(db_record)
         
+        # Current branch stock for every requested item, one IN query per table
+        medicine_ids = {i["id"] for i in items if i["type"] == "medicine"}
+        device_ids = {i["id"] for i in items if i["type"] == "medical_device"}
+        medicine_stock, device_stock = {}, {}
+        if medicine_ids:
+            medicine_stock = dict(db.execute(
+                select(DBMedicine.id, DBMedicine.quantity)
+                .where(DBMedicine.id.in_(medicine_ids), DBMedicine.branch_id == branch_id)
+            ).all())
+        if device_ids:
+            device_stock = dict(db.execute(
+                select(DBMedicalDevice.id, DBMedicalDevice.quantity)
+                .where(DBMedicalDevice.id.in_(device_ids), DBMedicalDevice.branch_id == branch_id)
+            ).all())
+
         # Process items
+        item_rows = []
+        item_ids = iter(new_ids(len(items)))
+        medicine_deltas, device_deltas = {}, {}
         for item in items:
             if item["type"] == "medicine":
-                # Decrease medicine quantity
-                medicine = db.query(DBMedicine).filter(
-                    DBMedicine.id == item["id"],
-                    DBMedicine.branch_id == branch_id
-                ).first()
-                
-                if not medicine or medicine.quantity < item["quantity"]:
-                    raise HTTPException(status_code=400, detail=f"Insufficient quantity for {item['name']}")
-                
-                medicine.quantity -= item["quantity"]
-                
-                # Create dispensing item
-                db_item = DBDispensingItem(
-                    id=str(uuid.uuid4()),
-                    record_id=record_id,
-                    item_type="medicine",
-                    item_id=item["id"],
-                    item_name=item["name"],
-                    quantity=item["quantity"]
-                )
-                db.add(db_item)
-            
+                stock, deltas = medicine_stock, medicine_deltas
             elif item["type"] == "medical_device":
-                # Decrease medical device quantity
-                device = db.query(DBMedicalDevice).filter(
-                    DBMedicalDevice.id == item["id"],
-                    DBMedicalDevice.branch_id == branch_id
-                ).first()
-                
-                if not device or device.quantity < item["quantity"]:
-                    raise HTTPException(status_code=400, detail=f"Insufficient quantity for {item['name']}")
-                
-                device.quantity -= item["quantity"]
-                
-                # Create dispensing item
-                db_item = DBDispensingItem(
-                    id=str(uuid.uuid4()),
-                    record_id=record_id,
-                    item_type="medical_device",
-                    item_id=item["id"],
-                    item_name=item["name"],
-                    quantity=item["quantity"]
-                )
-                db.add(db_item)
-        
+                stock, deltas = device_stock, device_deltas
+            else:
+                continue
+
+            # Earlier lines of this request may already draw on the same row
+            if item["id"] not in stock or stock[item["id"]] + deltas.get(item["id"], 0) < item["quantity"]:
+                raise HTTPException(status_code=400, detail=f"Insufficient quantity for {item['name']}")
+
+            deltas[item["id"]] = deltas.get(item["id"], 0) - item["quantity"]
+
+            # Create dispensing item
+            item_rows.append({
+                "id": next(item_ids),
+                "record_id": record_id,
+                "item_type": item["type"],
+                "item_id": item["id"],
+                "item_name": item["name"],
+                "quantity": item["quantity"],
+            })
+
+        apply_quantity_deltas(db, DBMedicine, medicine_deltas)
+        apply_quantity_deltas(db, DBMedicalDevice, device_deltas)
+
+        # The record row must exist before its items are bulk-inserted
+        db.flush()
+        if item_rows:
+            db.execute(insert(DBDispensingItem), item_rows)
+
         db.commit()
         return {"message": "Dispensing record created successfully"}
     except Exception as e:
@@ -1021,37 +1257,35 @@ async def create_dispensing_record(request: dict, db: Session = Depends(get_db))
 
 # Arrival endpoints
 @app.get("/arrivals")
-async def get_arrivals(db: Session = Depends(get_db)):
-    arrivals = db.query(DBArrival).all()
-    return {"data": [Arrival.model_validate(arrival) for arrival in arrivals]}
+def get_arrivals(db: Session = Depends(get_db)):
+    def build():
+        arrivals = arrival_list_adapter.validate_python(db.query(DBArrival).all(), from_attributes=True)
+        return {"data": arrival_list_adapter.dump_python(arrivals, mode="json")}
+
+    return ORJSONResponse(cached_response(("arrivals", "_all"), build))
 
 @app.post("/arrivals")
-async def create_arrivals(batch: BatchArrivalCreate, db: Session = Depends(get_db)):
+def create_arrivals(batch: BatchArrivalCreate, db: Session = Depends(get_db)):
     try:
-        for arrival_data in batch.arrivals:
-            # Create arrival record
-            db_arrival = DBArrival(
-                id=str(uuid.uuid4()),
-                medicine_id=arrival_data.medicine_id,
-                medicine_name=arrival_data.medicine_name,
-                quantity=arrival_data.quantity,
-                purchase_price=arrival_data.purchase_price,
-                sell_price=arrival_data.sell_price
-            )
-            db.add(db_arrival)
-            
-            # Update medicine quantity in main warehouse
-            medicine = db.query(DBMedicine).filter(
-                DBMedicine.id == arrival_data.medicine_id,
-                DBMedicine.branch_id.is_(None)
-            ).first()
-            
-            if medicine:
-                medicine.quantity += arrival_data.quantity
-                medicine.purchase_price = arrival_data.purchase_price
-                medicine.sell_price = arrival_data.sell_price
+        # Create arrival records
+        if batch.arrivals:
+            db.execute(insert(DBArrival), [
+                {
+                    "id": arrival_id,
+                    "medicine_id": arrival_data.medicine_id,
+                    "medicine_name": arrival_data.medicine_name,
+                    "quantity": arrival_data.quantity,
+                    "purchase_price": arrival_data.purchase_price,
+                    "sell_price": arrival_data.sell_price,
+                }
+                for arrival_id, arrival_data in zip(new_ids(len(batch.arrivals)), batch.arrivals)
+            ])
+
+        # Update medicine quantity and prices in main warehouse
+        receive_stock(db, DBMedicine, batch.arrivals, "medicine_id")
         
         db.commit()
+        invalidate_response(("arrivals", "_all"))
         return {"message": "Arrivals created successfully"}
     except Exception as e:
         db.rollback()
@@ -1059,35 +1293,34 @@ async def create_arrivals(batch: BatchArrivalCreate, db: Session = Depends(get_d
 
 
 @app.get("/device_arrivals")
-async def get_device_arrivals(db: Session = Depends(get_db)):
-    arrivals = db.query(DBDeviceArrival).all()
-    return {"data": [DeviceArrival.model_validate(a) for a in arrivals]}
+def get_device_arrivals(db: Session = Depends(get_db)):
+    def build():
+        arrivals = device_arrival_list_adapter.validate_python(db.query(DBDeviceArrival).all(), from_attributes=True)
+        return {"data": device_arrival_list_adapter.dump_python(arrivals, mode="json")}
+
+    return ORJSONResponse(cached_response(("device_arrivals", "_all"), build))
 
 
 @app.post("/device_arrivals")
-async def create_device_arrivals(batch: BatchDeviceArrivalCreate, db: Session = Depends(get_db)):
+def create_device_arrivals(batch: BatchDeviceArrivalCreate, db: Session = Depends(get_db)):
     try:
-        for arrival_data in batch.arrivals:
-            db_arrival = DBDeviceArrival(
-                id=str(uuid.uuid4()),
-                device_id=arrival_data.device_id,
-                device_name=arrival_data.device_name,
-                quantity=arrival_data.quantity,
-                purchase_price=arrival_data.purchase_price,
-                sell_price=arrival_data.sell_price,
-            )
-            db.add(db_arrival)
-
-            device = db.query(DBMedicalDevice).filter(
-                DBMedicalDevice.id == arrival_data.device_id,
-                DBMedicalDevice.branch_id.is_(None),
-            ).first()
-            if device:
-                device.quantity += arrival_data.quantity
-                device.purchase_price = arrival_data.purchase_price
-                device.sell_price = arrival_data.sell_price
+        if batch.arrivals:
+            db.execute(insert(DBDeviceArrival), [
+                {
+                    "id": arrival_id,
+                    "device_id": arrival_data.device_id,
+                    "device_name": arrival_data.device_name,
+                    "quantity": arrival_data.quantity,
+                    "purchase_price": arrival_data.purchase_price,
+                    "sell_price": arrival_data.sell_price,
+                }
+                for arrival_id, arrival_data in zip(new_ids(len(batch.arrivals)), batch.arrivals)
+            ])
+
+        receive_stock(db, DBMedicalDevice, batch.arrivals, "device_id")
 
         db.commit()
+        invalidate_response(("device_arrivals", "_all"))
         return {"message": "Device arrivals created successfully"}
     except Exception as e:
         db.rollback()
@@ -1095,161 +1328,139 @@ async def create_device_arrivals(batch: BatchDeviceArrivalCreate, db: Session =
 
 # Report endpoints
 @app.post("/reports/generate")
-async def generate_report(request: ReportRequest, db: Session = Depends(get_db)):
+def generate_report(request: ReportRequest):
     try:
-        report_data = []
+        # Rows stream straight from the cursor; the report is never held in memory.
+        # stream_rows executes every statement before returning, so query errors
+        # are still turned into a 400 below.
+        stmts = []
         
         if request.type == "stock":
-            if request.branch_id:
-                medicines = db.query(DBMedicine).filter(DBMedicine.branch_id == request.branch_id).all()
-                devices = db.query(DBMedicalDevice).filter(DBMedicalDevice.branch_id == request.branch_id).all()
-            else:
-                medicines = db.query(DBMedicine).filter(DBMedicine.branch_id.is_(None)).all()
-                devices = db.query(DBMedicalDevice).filter(DBMedicalDevice.branch_id.is_(None)).all()
-            
-            for med in medicines:
-                report_data.append({
-                    "id": med.id,
-                    "name": med.name,
-                    "type": "medicine",
-                    "quantity": med.quantity,
-                    "purchase_price": med.purchase_price,
-                    "sell_price": med.sell_price
-                })
-            
-            for dev in devices:
-                report_data.append({
-                    "id": dev.id,
-                    "name": dev.name,
-                    "type": "medical_device",
-                    "quantity": dev.quantity,
-                    "purchase_price": dev.purchase_price,
-                    "sell_price": dev.sell_price
-                })
+            for model, item_type in ((DBMedicine, "medicine"), (DBMedicalDevice, "medical_device")):
+                query = select(
+                    model.id,
+                    model.name,
+                    literal(item_type).label("type"),
+                    model.quantity,
+                    model.purchase_price,
+                    model.sell_price,
+                )
+                if request.branch_id:
+                    query = query.where(model.branch_id == request.branch_id)
+                else:
+                    query = query.where(model.branch_id.is_(None))
+                stmts.append(query)
         
         elif request.type == "dispensing":
-            query = db.query(DBDispensingRecord)
+            query = select(
+                DBDispensingRecord.id,
+                DBDispensingRecord.patient_name,
+                DBDispensingRecord.employee_name,
+                DBDispensingRecord.date,
+                DBDispensingRecord.branch_id,
+            )
             if request.branch_id:
-                query = query.filter(DBDispensingRecord.branch_id == request.branch_id)
+                query = query.where(DBDispensingRecord.branch_id == request.branch_id)
             if request.date_from:
-                query = query.filter(DBDispensingRecord.date >= request.date_from)
+                query = query.where(DBDispensingRecord.date >= request.date_from)
             if request.date_to:
-                query = query.filter(DBDispensingRecord.date <= request.date_to)
-            
-            records = query.all()
-            for record in records:
-                report_data.append({
-                    "id": record.id,
-                    "patient_name": record.patient_name,
-                    "employee_name": record.employee_name,
-                    "date": record.date.isoformat(),
-                    "branch_id": record.branch_id
-                })
+                query = query.where(DBDispensingRecord.date <= request.date_to)
+            stmts.append(query)
         
         elif request.type == "arrivals":
-            query = db.query(DBArrival)
+            query = select(
+                DBArrival.id,
+                DBArrival.medicine_name,
+                DBArrival.quantity,
+                DBArrival.purchase_price,
+                DBArrival.sell_price,
+                DBArrival.date,
+            )
             if request.date_from:
-                query = query.filter(DBArrival.date >= request.date_from)
+                query = query.where(DBArrival.date >= request.date_from)
             if request.date_to:
-                query = query.filter(DBArrival.date <= request.date_to)
-            
-            arrivals = query.all()
-            for arrival in arrivals:
-                report_data.append({
-                    "id": arrival.id,
-                    "medicine_name": arrival.medicine_name,
-                    "quantity": arrival.quantity,
-                    "purchase_price": arrival.purchase_price,
-                    "sell_price": arrival.sell_price,
-                    "date": arrival.date.isoformat()
-                })
+                query = query.where(DBArrival.date <= request.date_to)
+            stmts.append(query)
         
         elif request.type == "transfers":
-            query = db.query(DBTransfer)
+            query = select(
+                DBTransfer.id,
+                DBTransfer.medicine_name,
+                DBTransfer.quantity,
+                DBTransfer.from_branch_id,
+                DBTransfer.to_branch_id,
+                DBTransfer.date,
+            )
             if request.branch_id:
-                query = query.filter(DBTransfer.to_branch_id == request.branch_id)
+                query = query.where(DBTransfer.to_branch_id == request.branch_id)
             if request.date_from:
-                query = query.filter(DBTransfer.date >= request.date_from)
+                query = query.where(DBTransfer.date >= request.date_from)
             if request.date_to:
-                query = query.filter(DBTransfer.date <= request.date_to)
-            
-            transfers = query.all()
-            for transfer in transfers:
-                report_data.append({
-                    "id": transfer.id,
-                    "medicine_name": transfer.medicine_name,
-                    "quantity": transfer.quantity,
-                    "from_branch_id": transfer.from_branch_id,
-                    "to_branch_id": transfer.to_branch_id,
-                    "date": transfer.date.isoformat()
-                })
+                query = query.where(DBTransfer.date <= request.date_to)
+            stmts.append(query)
         
         elif request.type == "patients":
-            query = db.query(DBPatient)
+            query = select(
+                DBPatient.id,
+                DBPatient.first_name,
+                DBPatient.last_name,
+                DBPatient.illness,
+                DBPatient.phone,
+                DBPatient.address,
+                DBPatient.branch_id,
+            )
             if request.branch_id:
-                query = query.filter(DBPatient.branch_id == request.branch_id)
-            
-            patients = query.all()
-            for patient in patients:
-                report_data.append({
-                    "id": patient.id,
-                    "first_name": patient.first_name,
-                    "last_name": patient.last_name,
-                    "illness": patient.illness,
-                    "phone": patient.phone,
-                    "address": patient.address,
-                    "branch_id": patient.branch_id
-                })
+                query = query.where(DBPatient.branch_id == request.branch_id)
+            stmts.append(query)
         
         elif request.type == "medical_devices":
+            query = select(
+                DBMedicalDevice.id,
+                DBMedicalDevice.name,
+                DBMedicalDevice.quantity,
+                DBMedicalDevice.purchase_price,
+                DBMedicalDevice.sell_price,
+                DBMedicalDevice.branch_id,
+            )
             if request.branch_id:
-                devices = db.query(DBMedicalDevice).filter(DBMedicalDevice.branch_id == request.branch_id).all()
+                query = query.where(DBMedicalDevice.branch_id == request.branch_id)
             else:
-                devices = db.query(DBMedicalDevice).filter(DBMedicalDevice.branch_id.is_(None)).all()
-            
-            for device in devices:
-                report_data.append({
-                    "id": device.id,
-                    "name": device.name,
-                    "quantity": device.quantity,
-                    "purchase_price": device.purchase_price,
-                    "sell_price": device.sell_price,
-                    "branch_id": device.branch_id
-                })
+                query = query.where(DBMedicalDevice.branch_id.is_(None))
+            stmts.append(query)
         
-        return {"data": report_data}
+        return stream_rows(*stmts, wrap="data")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Calendar endpoints
 @app.get("/calendar/dispensing")
-async def get_calendar_dispensing(branch_id: Optional[str] = None, month: Optional[int] = None, year: Optional[int] = None, db: Session = Depends(get_db)):
+def get_calendar_dispensing(branch_id: Optional[str] = None, month: Optional[int] = None, year: Optional[int] = None, db: Session = Depends(get_db)):
     try:
-        query = db.query(DBDispensingRecord)
+        # One row per day with that day's records already shaped as JSON, in time order
+        day = cast(func.extract("day", DBDispensingRecord.date), Integer).label("day")
+        query = select(
+            day,
+            func.json_agg(aggregate_order_by(
+                func.json_build_object(
+                    "id", DBDispensingRecord.id,
+                    "patient_name", DBDispensingRecord.patient_name,
+                    "employee_name", DBDispensingRecord.employee_name,
+                    "time", func.to_char(DBDispensingRecord.date, "HH24:MI"),
+                ),
+                DBDispensingRecord.date,
+            )).label("records"),
+        ).group_by(day)
         if branch_id:
-            query = query.filter(DBDispensingRecord.branch_id == branch_id)
+            query = query.where(DBDispensingRecord.branch_id == branch_id)
         if month and year:
-            query = query.filter(
-                db.extract('month', DBDispensingRecord.date) == month,
-                db.extract('year', DBDispensingRecord.date) == year
+            query = query.where(
+                func.extract("month", DBDispensingRecord.date) == month,
+                func.extract("year", DBDispensingRecord.date) == year
             )
+
+        calendar_data = {row.day: row.records for row in db.execute(query)}
         
-        records = query.all()
-        calendar_data = {}
-        
-        for record in records:
-            day = record.date.day
-            if day not in calendar_data:
-                calendar_data[day] = []
-            
-            calendar_data[day].append({
-                "id": record.id,
-                "patient_name": record.patient_name,
-                "employee_name": record.employee_name,
-                "time": record.date.strftime("%H:%M")
-            })
-        
-        return {"data": calendar_data}
+        return ORJSONResponse({"data": calendar_data})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 